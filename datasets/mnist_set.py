@@ -1,3 +1,4 @@
+import os
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import matplotlib.pyplot as plt
@@ -17,8 +18,9 @@ class MnistSet:
         xy = tf.squeeze(pixels)
         pixel_indices = tf.where(tf.greater(xy, tf.constant(self.min_pixel_brightness, dtype=tf.uint8))) / 28
         size = tf.shape(pixel_indices)[0]
-        paddings = [[0, self.max_num_elements - tf.shape(pixel_indices)[0]], [0, 0]]
+        paddings = [[0, self.max_num_elements - size], [0, 0]]
         padded = tf.cast(tf.pad(pixel_indices, paddings, 'CONSTANT', self.pad_value), tf.float32)
+        padded.set_shape([self.max_num_elements, self.element_size])   # padding is dynamic, the result isn't
         return xy, padded, size, label
 
     def get_full_dataset(self):
@@ -28,22 +30,38 @@ class MnistSet:
         split = [f'train[:{self.train_split}%]']
         ds = tfds.load('mnist', split=split, shuffle_files=True)[0]
         assert isinstance(ds, tf.data.Dataset)
-        ds = ds.map(lambda row: self.pixels_to_set(row["image"], row["label"]))
+        ds = ds.map(lambda row: self.pixels_to_set(row["image"], row["label"]),
+                    num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
         ds.filter(lambda xy, padded, size, label: size > 50)
         return ds
 
+    def get_train_batches(self, batch_size, snapshot_dir):
+        options = tf.data.Options()
+        options.experimental_optimization.map_fusion = True
+        options.experimental_optimization.map_and_batch_fusion = True
+        options.experimental_optimization.parallel_batch = True
+        options.experimental_threading.private_threadpool_size = os.cpu_count()
+
+        # snapshot the converted sets to disk so later runs skip the mnist to set conversion entirely, then cache
+        # them in memory and overlap batching with training
+        return (self.get_train_set().apply(tf.data.experimental.snapshot(snapshot_dir))
+                .cache().shuffle(10000).batch(batch_size, drop_remainder=True)
+                .with_options(options).prefetch(tf.data.AUTOTUNE))
+
     def get_val_set(self):
         split = [f'train[{self.train_split}%:]']
         dataset = tfds.load('mnist', split=split)[0]
         assert isinstance(dataset, tf.data.Dataset)
-        dataset = dataset.map(lambda row: self.pixels_to_set(row["image"], row["label"]))
+        dataset = dataset.map(lambda row: self.pixels_to_set(row["image"], row["label"]),
+                              num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
         return dataset
 
     def get_test_set(self):
         split = ['test']
         dataset = tfds.load('mnist', split=split)[0]
         assert isinstance(dataset, tf.data.Dataset)
-        dataset = dataset.map(lambda row: self.pixels_to_set(row["image"], row["label"]))
+        dataset = dataset.map(lambda row: self.pixels_to_set(row["image"], row["label"]),
+                              num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
         return dataset
 
 
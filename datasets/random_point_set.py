@@ -29,6 +29,7 @@ class RandomPointSet:
         size = tf.shape(pixel_indices)[0]
         paddings = [[0, self.max_num_elements - tf.shape(pixel_indices)[0]], [0, 0]]
         padded = tf.cast(tf.pad(pixel_indices, paddings, 'CONSTANT', self.pad_value), tf.float32)
+        padded.set_shape([self.max_num_elements, self.element_size])
         return xy, padded, size, 0
 
     def get_train_set(self):
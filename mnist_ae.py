@@ -9,8 +9,6 @@ from visualisation import mnist_example
 import math
 import argparse
 import os
-import decimal
-from re import sub
 
 
 def set_config():
@@ -30,6 +28,9 @@ def set_config():
     config.size_pred_learning_rate = 0.0001
     config.weight_decay = 0.0000
     config.log_every = 500
+    # steps between training scalar summaries
+    config.scalar_log_every = 10
+    config.snapshot_dir = 'logs/cache/mnist_set/'
 
     # training config
     config.num_epochs = 100
@@ -54,6 +55,9 @@ class MnistAutoencoder:
         self.prior_optimiser = tf.keras.optimizers.Adam(self._c.prior_learning_rate)
         self.size_pred_optimiser = tf.keras.optimizers.Adam(self._c.size_pred_learning_rate)
 
+        self.log_weight_histograms = tf.function(self._log_weight_histograms,
+                                                 input_signature=[tf.TensorSpec([], tf.int64)])
+
         current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         train_log_dir = 'logs/metrics/ae/' + current_time
         checkpoint_folder = 'logs/checkpoints/ae/'
@@ -65,26 +69,24 @@ class MnistAutoencoder:
             self.ae.built = True
 
             def extract_sortable_value(value):
-                first_value = sub(r"\D", "", value)
-                return decimal.Decimal(first_value)
+                return int("".join(c for c in os.path.basename(value) if c.isdigit()) or 0)
 
             run_folders = [f.path for f in os.scandir(checkpoint_folder) if f.is_dir()]
-            run_folders = sorted(run_folders, key=extract_sortable_value)
-            latest_run = run_folders[-1]
+            latest_run = max(run_folders, key=extract_sortable_value)
 
             step_ckpnts = [f.path for f in os.scandir(latest_run) if f.is_dir()]
 
             if load_step == -1:
-                step_ckpnts = sorted(step_ckpnts, key=extract_sortable_value)
-                step_folder = step_ckpnts[-1]
+                step_folder = max(step_ckpnts, key=extract_sortable_value)
             else:
                 step_folder = [x for x in step_ckpnts if str(load_step) in x][0]
 
             self.ae.load_weights(step_folder + '/').expect_partial()
 
     def train_reconstruction(self):
-        train_ds = self.dataset.get_train_set().batch(self._c.batch_size)
-        val_ds = self.dataset.get_val_set().batch(self._c.batch_size)
+        train_ds = self.dataset.get_train_batches(self._c.batch_size, self._c.snapshot_dir)
+        val_ds = (self.dataset.get_val_set().cache()
+                  .batch(self._c.batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE))
 
         step = 0
         # start by training our prior
@@ -104,16 +106,15 @@ class MnistAutoencoder:
                 train_model_loss = self.train_ae_step(sets, sizes)
                 step += 1
 
-                with self.summary_writer.as_default():
-                    tf.summary.scalar('train/model loss', train_model_loss, step=step)
+                if step % self._c.scalar_log_every == 0:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar('train/model loss', train_model_loss, step=step)
 
                 if self.should_log(step):
                     print('logging ' + str(step))
                     self.ae.save_weights(self.checkpoint_dir + '/' + str(step) + '/')
 
-                    with self.summary_writer.as_default():
-                        for tf_var in self.ae.trainable_weights:
-                            tf.summary.histogram(tf_var.name, tf_var.numpy(), step=step)
+                    self.log_weight_histograms(tf.constant(step, tf.int64))
 
                     for images, sets, sizes, labels in val_ds.take(1):
                         val_prior_loss, val_model_loss, sampled_elements, pred_set = self.eval_ae_step(sets, sizes)
@@ -134,8 +135,10 @@ class MnistAutoencoder:
                 tf.summary.scalar('val/model loss', val_model_loss_sum / val_step, step=step)
 
     def train_size_predictor(self):
-        train_ds = self.dataset.get_train_set().batch(self._c.batch_size)
-        val_ds = self.dataset.get_val_set().batch(self._c.batch_size)
+        train_ds = (self.dataset.get_train_set().cache().shuffle(10000)
+                    .batch(self._c.batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE))
+        val_ds = (self.dataset.get_val_set().cache()
+                  .batch(self._c.batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE))
 
         step = 0
         for epoch in range(self._c.num_epochs):
@@ -144,8 +147,9 @@ class MnistAutoencoder:
                 train_model_loss = self.train_size_predictor_step(sets, sizes)
                 step += 1
 
-                with self.summary_writer.as_default():
-                    tf.summary.scalar('train/size predictor loss', train_model_loss, step=step)
+                if step % self._c.scalar_log_every == 0:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar('train/size predictor loss', train_model_loss, step=step)
 
                 if self.should_log(step):
                     print('logging ' + str(step))
@@ -155,16 +159,20 @@ class MnistAutoencoder:
             val_count = 0
 
             for val_step, (images, sets, sizes, labels) in enumerate(val_ds):
-                predicted_sizes, val_model_loss = self.eval_size_predictor_step(sets, sizes)
-                for i in range(len(predicted_sizes)):
-                    val_count += 1
-                    val_model_SE_sum += math.pow(predicted_sizes[i] - sizes[i], 2)
+                squared_error, batch_count, val_model_loss = self.eval_size_predictor_step(sets, sizes)
+                val_model_SE_sum += squared_error
+                val_count += batch_count
 
-            rmse = math.sqrt(val_model_SE_sum / val_count)
+            rmse = math.sqrt(float(val_model_SE_sum) / int(val_count))
 
             with self.summary_writer.as_default():
                 tf.summary.scalar('val/size predictor RMSE', rmse, step=step)
 
+    def _log_weight_histograms(self, step):
+        with self.summary_writer.as_default():
+            for tf_var in self.ae.trainable_weights:
+                tf.summary.histogram(tf_var.name, tf_var, step=step)
+
     def prior_loss(self, initial_set, sizes):
         sampled_set = self.ae.sample_prior(sizes)
 
@@ -220,11 +228,12 @@ class MnistAutoencoder:
 
     @tf.function
     def size_predictor_loss(self, embedded_sets, sizes):
-        pred_sizes = self.ae.predict_size(embedded_sets)
+        pred_size_logits = self.ae.predict_size_logits(embedded_sets)
 
-        one_hot_sizes = tf.one_hot(sizes - 1, self.max_set_size)    # decrement indices by 1 as not sets are size 0
-        size_loss = tf.reduce_mean(tf.keras.losses.categorical_crossentropy(one_hot_sizes, pred_sizes))
-        predicted_sizes = tf.cast(tf.argmax(pred_sizes, 1), tf.int32) + 1
+        # decrement indices by 1 as not sets are size 0
+        size_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=sizes - 1,
+                                                                                  logits=pred_size_logits))
+        predicted_sizes = tf.argmax(pred_size_logits, 1, output_type=tf.int32) + 1
         return predicted_sizes, size_loss
 
     @tf.function
@@ -244,7 +253,9 @@ class MnistAutoencoder:
         embedded_sets = self.ae.encode_set(initial_sets, sizes)  # pooled: [batch_size, num_features]
         set_sizes_pred, size_loss = self.size_predictor_loss(embedded_sets, sizes)
 
-        return set_sizes_pred, size_loss
+        # reduce the squared error here rather than pulling every prediction back to python
+        squared_error = tf.reduce_sum(tf.square(tf.cast(set_sizes_pred - sizes, tf.float32)))
+        return squared_error, tf.shape(sizes)[0], size_loss
 
 
 if __name__ == '__main__':
@@ -10,8 +10,6 @@ from visualisation import mnist_example
 import math
 import argparse
 import os
-import decimal
-from re import sub
 
 
 def set_config():
@@ -31,10 +29,22 @@ def set_config():
     config.size_pred_learning_rate = 0.0001
     config.weight_decay = 0.00001
     config.log_every = 500
+    # writing a scalar forces a sync with the device, so training scalars are only written every few steps
+    config.scalar_log_every = 10
+    config.snapshot_dir = 'logs/cache/mnist_set/'
+    config.export_dir = 'logs/saved_models/vae/'
+
+    # run the encoder and decoder in bfloat16, the latent, set prediction, prior, size predictor and loss stay in float32
+    config.mixed_precision = True
+    # run the decoder's pointwise layers on only the real set elements. the packed shapes are data dependent, so this
+    # turns off XLA for the model and the training step
+    config.remove_padding = False
 
     # training config
     config.num_epochs = 100
     config.batch_size = 64
+    # number of batch_size micro-batches whose gradients are summed before each optimiser step
+    config.accumulation_steps = 1
     return config
 
 
@@ -48,13 +58,29 @@ class MnistVariationalAutoencoder:
         self.dataset = dataset
 
         self.vae = SetVariationalAutoEncoderV2(self._c.encoder_latent, self._c.trans_layers, self._c.trans_attn_size, self._c.trans_num_heads,
-                                 self.dataset.element_size, self._c.size_pred_width, self._c.pad_value, self.dataset.max_num_elements)
+                                 self.dataset.element_size, self._c.size_pred_width, self._c.pad_value, self.dataset.max_num_elements,
+                                 self._c.remove_padding)
         self.vae.compile()
 
         self.reconstruction_optimiser = OneCycleAdamW(self._c.reconstruction_learning_rate, config.weight_decay, 200000)
         self.prior_optimiser = tf.keras.optimizers.Adam(self._c.prior_learning_rate)
         self.size_pred_optimiser = tf.keras.optimizers.Adam(self._c.size_pred_learning_rate)
 
+        # fix the step signatures so the final partial batch or a new batch size doesn't trigger a retrace
+        set_spec = [tf.TensorSpec([None, self.max_set_size, self.element_size], tf.float32),
+                    tf.TensorSpec([None], tf.int32)]
+        embedding_spec = [tf.TensorSpec([None, self.vae.latent_dim], tf.float32), tf.TensorSpec([None], tf.int32)]
+
+        # compile the whole training step with XLA so the transformer and chamfer loss ops get fused
+        self.train_vae_step = tf.function(self._train_vae_step, input_signature=set_spec,
+                                          jit_compile=not self._c.remove_padding)
+        self.eval_vae_step = tf.function(self._eval_vae_step, input_signature=set_spec)
+        self.size_predictor_loss = tf.function(self._size_predictor_loss, input_signature=embedding_spec)
+        self.train_size_predictor_step = tf.function(self._train_size_predictor_step, input_signature=set_spec)
+        self.eval_size_predictor_step = tf.function(self._eval_size_predictor_step, input_signature=set_spec)
+        self.log_weight_histograms = tf.function(self._log_weight_histograms,
+                                                 input_signature=[tf.TensorSpec([], tf.int64)])
+
         current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         train_log_dir = 'logs/metrics/vae/' + current_time
         checkpoint_folder = 'logs/checkpoints/vae/'
@@ -65,27 +91,62 @@ class MnistVariationalAutoencoder:
         if load_step is not None:
             self.vae.built = True
 
+            # folders are named by timestamp or step, so sort on the digits in the folder name
             def extract_sortable_value(value):
-                first_value = sub(r"\D", "", value)
-                return decimal.Decimal(first_value)
+                return int("".join(c for c in os.path.basename(value) if c.isdigit()) or 0)
 
             run_folders = [f.path for f in os.scandir(checkpoint_folder) if f.is_dir()]
-            run_folders = sorted(run_folders, key=extract_sortable_value)
-            latest_run = run_folders[-1]
+            latest_run = max(run_folders, key=extract_sortable_value)
 
             step_ckpnts = [f.path for f in os.scandir(latest_run) if f.is_dir()]
 
             if load_step == -1:
-                step_ckpnts = sorted(step_ckpnts, key=extract_sortable_value)
-                step_folder = step_ckpnts[-1]
+                step_folder = max(step_ckpnts, key=extract_sortable_value)
             else:
                 step_folder = [x for x in step_ckpnts if str(load_step) in x][0]
 
             self.vae.load_weights(step_folder + '/').expect_partial()
 
+    def export_saved_model(self, export_path):
+        # trace the eval reconstruction once for a fixed set shape and save it as a standalone graph, so inference
+        # doesn't need this repo or any python in the loop. the model's own XLA clusters are kept in the saved graph
+        vae = self.vae
+        set_spec = [tf.TensorSpec([None, self.max_set_size, self.element_size], tf.float32),
+                    tf.TensorSpec([None], tf.int32)]
+
+        class ReconstructionModule(tf.Module):
+            def __init__(self):
+                super(ReconstructionModule, self).__init__()
+                self.vae = vae
+
+            @tf.function(input_signature=set_spec)
+            def reconstruct(self, sets, sizes):
+                sampled_set = self.vae.sample_prior_batch(sizes)
+                return self.vae(sets, sampled_set, sizes, True)
+
+        module = ReconstructionModule()
+        tf.saved_model.save(module, export_path, signatures={'reconstruct': module.reconstruct.get_concrete_function()})
+        print('saved model exported to {}'.format(export_path))
+
+    def export_size_predictor_tflite(self, export_path):
+        # the size predictor runs once per generated set, so serve it as a small tflite model with its weights stored
+        # as int8. only the weights are quantised, the activations and the softmax stay in float32
+        predict_size = tf.function(self.vae.predict_size,
+                                   input_signature=[tf.TensorSpec([None, self.vae.latent_dim], tf.float32)])
+
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([predict_size.get_concrete_function()])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        tflite_model = converter.convert()
+
+        with open(export_path, 'wb') as f:
+            f.write(tflite_model)
+        print('size predictor exported to {}'.format(export_path))
+
     def train_reconstruction(self):
-        train_ds = self.dataset.get_train_set().batch(self._c.batch_size)
-        val_ds = self.dataset.get_val_set().batch(self._c.batch_size)
+        train_ds = self.dataset.get_train_batches(self._c.batch_size * self._c.accumulation_steps,
+                                                  self._c.snapshot_dir)
+        val_ds = (self.dataset.get_val_set().cache()
+                  .batch(self._c.batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE))
 
         step = 0
         # start by training our prior
@@ -105,16 +166,15 @@ class MnistVariationalAutoencoder:
                 train_model_loss = self.train_vae_step(sets, sizes)
                 step += 1
 
-                with self.summary_writer.as_default():
-                    tf.summary.scalar('train/model loss', train_model_loss, step=step)
+                if step % self._c.scalar_log_every == 0:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar('train/model loss', train_model_loss, step=step)
 
                 if self.should_log(step):
                     print('logging ' + str(step))
                     self.vae.save_weights(self.checkpoint_dir + '/' + str(step) + '/')
 
-                    with self.summary_writer.as_default():
-                        for tf_var in self.vae.trainable_weights:
-                            tf.summary.histogram(tf_var.name, tf_var.numpy(), step=step)
+                    self.log_weight_histograms(tf.constant(step, tf.int64))
 
                     for images, sets, sizes, labels in val_ds.take(1):
                         val_prior_loss, val_model_loss, sampled_elements, pred_set = self.eval_vae_step(sets, sizes)
@@ -135,8 +195,11 @@ class MnistVariationalAutoencoder:
                 tf.summary.scalar('val/model loss', val_model_loss_sum / val_step, step=step)
 
     def train_size_predictor(self):
-        train_ds = self.dataset.get_train_set().batch(self._c.batch_size)
-        val_ds = self.dataset.get_val_set().batch(self._c.batch_size)
+        # mnist sets fit comfortably in memory, so cache the converted sets and overlap batching with training
+        train_ds = (self.dataset.get_train_set().cache().shuffle(10000)
+                    .batch(self._c.batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE))
+        val_ds = (self.dataset.get_val_set().cache()
+                  .batch(self._c.batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE))
 
         step = 0
         for epoch in range(self._c.num_epochs):
@@ -145,8 +208,9 @@ class MnistVariationalAutoencoder:
                 train_model_loss = self.train_size_predictor_step(sets, sizes)
                 step += 1
 
-                with self.summary_writer.as_default():
-                    tf.summary.scalar('train/size predictor loss', train_model_loss, step=step)
+                if step % self._c.scalar_log_every == 0:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar('train/size predictor loss', train_model_loss, step=step)
 
                 if self.should_log(step):
                     print('logging ' + str(step))
@@ -156,16 +220,21 @@ class MnistVariationalAutoencoder:
             val_count = 0
 
             for val_step, (images, sets, sizes, labels) in enumerate(val_ds):
-                predicted_sizes, val_model_loss = self.eval_size_predictor_step(sets, sizes)
-                for i in range(len(predicted_sizes)):
-                    val_count += 1
-                    val_model_SE_sum += math.pow(predicted_sizes[i] - sizes[i], 2)
+                squared_error, batch_count, val_model_loss = self.eval_size_predictor_step(sets, sizes)
+                val_model_SE_sum += squared_error
+                val_count += batch_count
 
-            rmse = math.sqrt(val_model_SE_sum / val_count)
+            rmse = math.sqrt(float(val_model_SE_sum) / int(val_count))
 
             with self.summary_writer.as_default():
                 tf.summary.scalar('val/size predictor RMSE', rmse, step=step)
 
+    def _log_weight_histograms(self, step):
+        # stays in graph mode so the weights are copied off the device by tf rather than through .numpy()
+        with self.summary_writer.as_default():
+            for tf_var in self.vae.trainable_weights:
+                tf.summary.histogram(tf_var.name, tf_var, step=step)
+
     def reconstruction_loss(self, x, sampled_set, sizes, eval_mode=False):
         set_dist = self.vae(x, sampled_set, sizes, eval_mode)
 
@@ -174,36 +243,49 @@ class MnistVariationalAutoencoder:
 
         return set_dist, chamfer_dst
 
-    @tf.function
-    def train_vae_step(self, initial_set, sizes):
-        sampled_set = self.vae.sample_prior_batch(sizes)
+    def _train_vae_step(self, initial_set, sizes):
+        # split the batch into micro-batches and accumulate their gradients, so the effective batch can grow without
+        # the chamfer loss having to hold the whole batch at once. the split is unrolled while tracing
+        accumulation_steps = self._c.accumulation_steps
+        accumulated_grads = None
+        accumulated_loss = 0.0
 
-        with tf.GradientTape() as model_tape:
-            pred_set, model_loss = self.reconstruction_loss(initial_set, sampled_set, sizes)
+        for micro_set, micro_sizes in zip(tf.split(initial_set, accumulation_steps),
+                                          tf.split(sizes, accumulation_steps)):
+            sampled_set = self.vae.sample_prior_batch(micro_sizes)
 
-        model_trainables = self.vae.get_autoencoder_weights()
-        model_grads = model_tape.gradient(model_loss, model_trainables)
+            with tf.GradientTape() as model_tape:
+                pred_set, model_loss = self.reconstruction_loss(micro_set, sampled_set, micro_sizes)
+
+            model_trainables = self.vae.get_autoencoder_weights()
+            model_grads = model_tape.gradient(model_loss, model_trainables)
+
+            if accumulated_grads is None:
+                accumulated_grads = model_grads
+            else:
+                accumulated_grads = [acc + grad for acc, grad in zip(accumulated_grads, model_grads)]
+            accumulated_loss += model_loss
+
+        model_grads = [grad / accumulation_steps for grad in accumulated_grads]
         self.reconstruction_optimiser.apply_gradients(zip(model_grads, model_trainables))
-        return model_loss
+        return accumulated_loss / accumulation_steps
 
-    @tf.function
-    def eval_vae_step(self, x, sizes):
+    def _eval_vae_step(self, x, sizes):
         # padded_samples, prior_loss = self.prior_loss(x, sizes)
         padded_samples = self.vae.sample_prior_batch(sizes)
         pred_set, model_loss = self.reconstruction_loss(x, padded_samples, sizes, eval_mode=True)
         return 0.0, model_loss, padded_samples, pred_set
 
-    @tf.function
-    def size_predictor_loss(self, embedded_sets, sizes):
-        pred_sizes = self.vae.predict_size(embedded_sets)
+    def _size_predictor_loss(self, embedded_sets, sizes):
+        pred_size_logits = self.vae.predict_size_logits(embedded_sets)
 
-        one_hot_sizes = tf.one_hot(sizes - 1, self.max_set_size)    # decrement indices by 1 as not sets are size 0
-        size_loss = tf.reduce_mean(tf.keras.losses.categorical_crossentropy(one_hot_sizes, pred_sizes))
-        predicted_sizes = tf.cast(tf.argmax(pred_sizes, 1), tf.int32) + 1
+        # decrement indices by 1 as not sets are size 0
+        size_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=sizes - 1,
+                                                                                  logits=pred_size_logits))
+        predicted_sizes = tf.argmax(pred_size_logits, 1, output_type=tf.int32) + 1
         return predicted_sizes, size_loss
 
-    @tf.function
-    def train_size_predictor_step(self, initial_sets, sizes):
+    def _train_size_predictor_step(self, initial_sets, sizes):
         embedded_sets = self.vae.encode_set(initial_sets, sizes)  # pooled: [batch_size, num_features]
 
         with tf.GradientTape() as size_tape:
@@ -214,12 +296,13 @@ class MnistVariationalAutoencoder:
         self.reconstruction_optimiser.apply_gradients(zip(model_grads, size_trainables))
         return size_loss
 
-    @tf.function
-    def eval_size_predictor_step(self, initial_sets, sizes):
+    def _eval_size_predictor_step(self, initial_sets, sizes):
         embedded_sets = self.vae.encode_set(initial_sets, sizes)  # pooled: [batch_size, num_features]
         set_sizes_pred, size_loss = self.size_predictor_loss(embedded_sets, sizes)
 
-        return set_sizes_pred, size_loss
+        # reduce the squared error here rather than pulling every prediction back to python
+        squared_error = tf.reduce_sum(tf.square(tf.cast(set_sizes_pred - sizes, tf.float32)))
+        return squared_error, tf.shape(sizes)[0], size_loss
 
 
 if __name__ == '__main__':
@@ -229,16 +312,27 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--predictor', action='store_true', help='train the size predictor using the existing '
                                                                        'autoencoder model')
     parser.add_argument('-d', '--debug', action='store_true', help='enable eager execution for debugging')
+    parser.add_argument('-e', '--export', action='store_true', help='export the reconstruction graph as a SavedModel '
+                                                                    'and the size predictor as a quantised tflite '
+                                                                    'model, use with -s to export trained weights')
 
     args = parser.parse_args()
 
     config = set_config()
+
+    if config.mixed_precision:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
     dataset = MnistSet(config.train_split, config.pad_value, 20)
     set_vae = MnistVariationalAutoencoder(args.step, config, dataset)
 
     tf.config.experimental_run_functions_eagerly(args.debug)
 
-    if args.predictor:
+    if args.export:
+        export_folder = config.export_dir + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + '/'
+        set_vae.export_saved_model(export_folder + 'reconstruction/')
+        set_vae.export_size_predictor_tflite(export_folder + 'size_predictor.tflite')
+    elif args.predictor:
         set_vae.train_size_predictor()
     else:
         set_vae.train_reconstruction()
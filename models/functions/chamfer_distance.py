@@ -11,20 +11,22 @@ def chamfer_distance_smoothed(point_set_a, point_set_b, sizes):
     a = tf.expand_dims(point_set_a, axis=-2)
     b = tf.expand_dims(point_set_b, axis=-3)
 
-    largest_unpadded_dim = tf.reduce_max(sizes)
-    row_sizes = tf.repeat(sizes, sizes)
-    a = a[:, :largest_unpadded_dim, :largest_unpadded_dim, :]
-    b = b[:, :largest_unpadded_dim, :largest_unpadded_dim, :]
-    a = tf.RaggedTensor.from_tensor(tf.repeat(a, largest_unpadded_dim, -2), lengths=(sizes, row_sizes))
-    b = tf.RaggedTensor.from_tensor(tf.repeat(b, largest_unpadded_dim, -3), lengths=(sizes, row_sizes))
+    square_distances = tf.keras.losses.huber(a, b)     # [batch, set_size, set_size]
 
-    square_distances = tf.keras.losses.huber(a, b)
+    # push padded pairs to a large distance so they never win the min, this keeps every shape static unlike
+    # trimming to the largest set and using a RaggedTensor
+    row_mask = tf.sequence_mask(sizes, tf.shape(square_distances)[-1])
+    pair_mask = tf.logical_and(row_mask[:, :, None], row_mask[:, None, :])
+    square_distances = tf.where(pair_mask, square_distances, square_distances.dtype.max / 2)
 
     minimum_square_distance_a_to_b = tf.reduce_min(input_tensor=square_distances, axis=-1)
     minimum_square_distance_b_to_a = tf.reduce_min(input_tensor=square_distances, axis=-2)
 
-    setwise_distance = (tf.reduce_mean(input_tensor=minimum_square_distance_a_to_b, axis=-1) +
-                        tf.reduce_mean(input_tensor=minimum_square_distance_b_to_a, axis=-1))
+    # average over the unpadded elements only
+    unpadded = tf.cast(row_mask, square_distances.dtype)
+    set_sizes = tf.cast(sizes, square_distances.dtype)
+    setwise_distance = (tf.reduce_sum(input_tensor=minimum_square_distance_a_to_b * unpadded, axis=-1) / set_sizes +
+                        tf.reduce_sum(input_tensor=minimum_square_distance_b_to_a * unpadded, axis=-1) / set_sizes)
     return setwise_distance
 
 
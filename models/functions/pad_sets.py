@@ -0,0 +1,16 @@
+import tensorflow as tf
+
+
+def scatter_to_padded(elements, sizes, max_size, pad_value):
+    """Scatter a flat batch of set elements into a padded [batch_size, max_size, num_features] tensor.
+
+    Element k of set b lands at [b, k], the remaining positions are filled with pad_value.
+    """
+    batch_size = tf.shape(sizes)[0]
+    set_offsets = tf.math.cumsum(sizes, exclusive=True)
+    rows = tf.repeat(tf.range(batch_size), sizes)
+    cols = tf.range(tf.reduce_sum(sizes)) - tf.repeat(set_offsets, sizes)
+    indices = tf.stack([rows, cols], 1)
+
+    padding = tf.fill([batch_size, max_size, tf.shape(elements)[-1]], tf.cast(pad_value, elements.dtype))
+    return tf.tensor_scatter_nd_update(padding, indices, elements)
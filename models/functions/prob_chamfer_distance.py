@@ -1,3 +1,4 @@
+import math
 import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 
@@ -7,39 +8,67 @@ from tensorflow_probability import distributions as tfd
 
 # modification of chamfer distance to calculate smallest log_prob between a set distribution and another set
 # log_prob instead of huber loss as a distance metric
-def prob_chamfer_distance(set_dists, set, sizes, max_size):
-
-    # compare each element with every other element
-    probs = []
-
-    # definitely not ideal to operate row by row, but it takes a boatload of memory to allocate the full [batch, set_size, set_size, features] array all at once
-    set_row = tf.split(set, max_size, axis=-2)
-
-    for i in range(max_size):
-        set_prob = set_dists.log_prob(set_row[i])
-        probs.append(set_prob)
-
-    log_probs = tf.stack(probs, axis=-2)
-
-    # flatten our batch dimensions so we just have [batch, elements, elements]
-    log_probs = tf.reshape(log_probs, (-1, max_size, max_size))
+def prob_chamfer_distance(set_dists, set, sizes, max_size, block_size=32):
+    # flatten our batch dimensions so we just have [batch, elements, features]
+    num_features = tf.shape(set)[-1]
+    loc = set_dists.distribution.loc
+    scale = tf.broadcast_to(set_dists.distribution.scale, tf.shape(loc))
+    loc = tf.reshape(loc, (-1, max_size, num_features))
+    scale = tf.reshape(scale, (-1, max_size, num_features))
+    set_flat = tf.reshape(set, (-1, max_size, num_features))
+    sizes_flat = tf.reshape(tf.cast(sizes, tf.int32), (-1,))
+    batch_size = tf.shape(set_flat)[0]
+
+    # compare each element with every other element by broadcasting the distribution parameters against the set,
+    # log_probs[..., i, j] is the log_prob of set element i under element distribution j. the independent normal
+    # log_prob is written out directly rather than rebuilding a tfd distribution around the broadcast parameters
+    loc = tf.expand_dims(loc, -3)
+    scale = tf.expand_dims(scale, -3)
+    log_normaliser = tf.math.log(scale) + 0.5 * math.log(2. * math.pi)
+
+    def pairwise_log_prob(x):
+        z = (x - loc) / scale
+        return tf.reduce_sum(-0.5 * tf.square(z) - log_normaliser, axis=-1)
+
+    # it takes a boatload of memory to allocate the full [batch, set_size, set_size] array all at once, so set
+    # elements are compared a block at a time and the max in each direction is streamed into running results.
+    # pad the set so it splits evenly into blocks, the extra rows get masked out along with the existing padding
+    num_blocks = -(-max_size // block_size)
+    padded_size = num_blocks * block_size
+    set_padded = tf.pad(set_flat, [[0, 0], [0, padded_size - max_size], [0, 0]])
 
     # remove the padded values before finding the min distance, otherwise the model can abuse the padding to
-    # achieve lower chamfer loss and not actually learn anything
-    # slice off the known extras from our tensor, otherwise raggedTensor throws an error if the final ragged
-    # tensor can be squeezed smaller than the initial size (ie. at least one row / column needs to be current size)
-    sizes_flat = tf.reshape(sizes, (-1,))
-    largest_unpadded_dim = tf.reduce_max(sizes_flat)
-    log_probs_trimmed = log_probs[:, :largest_unpadded_dim, :largest_unpadded_dim]
-
-    row_sizes = tf.repeat(sizes_flat, sizes_flat)
-    log_probs = tf.RaggedTensor.from_tensor(log_probs_trimmed, lengths=(sizes_flat, row_sizes))
-
-    minimum_square_distance_a_to_b = tf.reduce_max(input_tensor=log_probs, axis=-1)
-    minimum_square_distance_b_to_a = tf.reduce_max(input_tensor=log_probs, axis=-2)
-
-    setwise_distance = (tf.reduce_mean(input_tensor=minimum_square_distance_a_to_b, axis=-1) +
-                        tf.reduce_mean(input_tensor=minimum_square_distance_b_to_a, axis=-1))
+    # achieve lower chamfer loss and not actually learn anything. padded pairs are pushed to a large negative value
+    # so they never win the max
+    row_mask = tf.sequence_mask(sizes_flat, max_size)
+    row_mask_padded = tf.sequence_mask(sizes_flat, padded_size)
+    masked_value = tf.constant(set.dtype.min / 2, set.dtype)
+
+    def compare_block(i, max_a_to_b, max_b_to_a):
+        start = i * block_size
+        set_block = set_padded[:, start:start + block_size]
+        block_mask = row_mask_padded[:, start:start + block_size]
+
+        log_probs = pairwise_log_prob(tf.expand_dims(set_block, -2))     # [batch, block_size, elements]
+        pair_mask = tf.logical_and(block_mask[:, :, None], row_mask[:, None, :])
+        log_probs = tf.where(pair_mask, log_probs, masked_value)
+
+        max_a_to_b = max_a_to_b.write(i, tf.reduce_max(input_tensor=log_probs, axis=-1))
+        max_b_to_a = tf.maximum(max_b_to_a, tf.reduce_max(input_tensor=log_probs, axis=-2))
+        return i + 1, max_a_to_b, max_b_to_a
+
+    _, max_a_to_b, minimum_square_distance_b_to_a = tf.while_loop(
+        lambda i, *_: i < num_blocks, compare_block,
+        (0, tf.TensorArray(set.dtype, size=num_blocks), tf.fill([batch_size, max_size], masked_value)))
+
+    # blocks come back stacked as [num_blocks, batch, block_size]
+    minimum_square_distance_a_to_b = tf.reshape(tf.transpose(max_a_to_b.stack(), (1, 0, 2)),
+                                                (-1, padded_size))[:, :max_size]
+
+    # average over the unpadded elements only
+    set_sizes = tf.cast(sizes_flat, set.dtype)
+    setwise_distance = (tf.reduce_sum(tf.where(row_mask, minimum_square_distance_a_to_b, 0.), axis=-1) / set_sizes +
+                        tf.reduce_sum(tf.where(row_mask, minimum_square_distance_b_to_a, 0.), axis=-1) / set_sizes)
 
     out_shape = tf.shape(set)[:-2]
     batch_shaped = tf.reshape(setwise_distance, shape=out_shape)
@@ -90,5 +119,5 @@ if __name__ == '__main__':
     sizes = tf.random.uniform([10, 10], 50, 150, dtype=tf.int32)
 
     dist = tfd.Independent(tfd.Normal(mean, 1), 1)
-    out = prob_chamfer_distance(dist, mean, sizes)
+    out = prob_chamfer_distance(dist, mean, sizes, 200)
     pass
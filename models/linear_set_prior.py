@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 
 class DeterministicSetPrior(tf.keras.Model):
     def __init__(self, event_size, max_size, *args, **kwargs):
-        super(DeterministicSetPrior, self).__init__()
+        super(DeterministicSetPrior, self).__init__(**kwargs)
         self.event_size = event_size
         self.max_size = max_size
 
@@ -14,8 +14,8 @@ class DeterministicSetPrior(tf.keras.Model):
         start = tf.zeros_like(max_vals)
 
         feature_scales = tf.transpose(tf.linspace(start, max_vals, self.max_size), (1, 0))
-        masking = tf.RaggedTensor.from_tensor(feature_scales, set_sizes)
-        feature_scale_masked = tf.expand_dims(masking.to_tensor(shape=(batch_size, self.max_size)), -1)
+        masking = tf.sequence_mask(set_sizes, self.max_size, dtype=tf.float32)
+        feature_scale_masked = tf.expand_dims(feature_scales * masking, -1)
 
         initial_set = tf.ones((batch_size, self.max_size, self.event_size)) * feature_scale_masked
 
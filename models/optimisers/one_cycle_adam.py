@@ -1,3 +1,4 @@
+import math
 import tensorflow as tf
 import tensorflow_addons as tfa
 
@@ -18,59 +19,65 @@ class OneCycleSchedule(tf.optimizers.schedules.LearningRateSchedule):
         self._warmup_end_step = int(cycle_length * 0.1)
         self._max_end_step = self._warmup_end_step + int(cycle_length * 0.3)
         self._decay_end_step = self._max_end_step + int(cycle_length * 0.6)
+        # the final decay is (1 - 1 / decay_end_step) ^ step, keep the log of the base so it's a single exp per step
+        self._final_decay_log = math.log(1.0 - 1.0 / self._decay_end_step)
+
+        # lr, weight decay and momentum are each read from the schedule every optimiser step, so remember the
+        # factors for the last step seen and only evaluate the schedule once per step
+        self._last_step = tf.Variable(-1, trainable=False, dtype=tf.int64)
+        self._last_lr_factor = tf.Variable(0.0, trainable=False, dtype=tf.float32)
+        self._last_momentum = tf.Variable(0.0, trainable=False, dtype=tf.float32)
 
     def __call__(self, step):
-        def warmup():
-            # interpolate between initial and max lr
-            lr_factor = tf.cast(0.1 + 0.9 * (step / self._warmup_end_step), tf.float32)
-            return lr_factor
-
-        def max_lr():
-            # remain at max for a period
-            return tf.constant(1.0, tf.float32)
-
-        def initial_decay():
-            # decay at half the speed we warmed up at
-            decay_step = step - self._max_end_step
-            lr_factor = tf.cast(1 - 0.9 * (decay_step / (self._decay_end_step - self._max_end_step)), tf.float32)
-            return lr_factor
-
-        def final_decay():
-            # then exponential decay from there
-            final_step = tf.cast(step - self._decay_end_step, tf.float32)
-            lr_factor = tf.cast(0.1 * tf.math.pow(1 - 1 / self._decay_end_step, final_step), tf.float32)
-            return lr_factor
-
-        learning_rate = tf.case([(tf.less_equal(step, self._warmup_end_step), warmup),
-                                 (tf.less_equal(step, self._max_end_step), max_lr),
-                                 (tf.less_equal(step, self._decay_end_step), initial_decay)],
-                                default=final_decay)
+        return self._cached_factors(step)[0]
+
+    def get_momentum(self, step):
+        return self._cached_factors(step)[1]
+
+    def _cached_factors(self, step):
+        step = tf.cast(step, tf.int64)
+
+        def cached():
+            return self._last_lr_factor.read_value(), self._last_momentum.read_value()
+
+        def recompute():
+            lr_factor = self.lr_factor(step)
+            momentum = self.momentum(step)
+            with tf.control_dependencies([self._last_step.assign(step),
+                                          self._last_lr_factor.assign(lr_factor),
+                                          self._last_momentum.assign(momentum)]):
+                return tf.identity(lr_factor), tf.identity(momentum)
+
+        return tf.cond(tf.equal(step, self._last_step), cached, recompute)
+
+    def lr_factor(self, step):
+        step = tf.cast(step, tf.float32)
+
+        # interpolate between initial and max lr
+        warmup = 0.1 + 0.9 * (step / self._warmup_end_step)
+        # decay at half the speed we warmed up at
+        initial_decay = 1 - 0.9 * ((step - self._max_end_step) / (self._decay_end_step - self._max_end_step))
+        # then exponential decay from there
+        final_decay = 0.1 * tf.exp((step - self._decay_end_step) * self._final_decay_log)
+
+        # every segment is cheap elementwise math, so evaluate them all and select rather than branching
+        learning_rate = tf.where(step <= self._warmup_end_step, warmup,
+                                 tf.where(step <= self._max_end_step, 1.0,
+                                          tf.where(step <= self._decay_end_step, initial_decay, final_decay)))
 
         return learning_rate
 
-    def get_momentum(self, step):
-        def warmup():
-            # interpolate between initial and max momentum
-            momentum = tf.cast(0.95 - 0.1 * (step / self._warmup_end_step), tf.float32)
-            return momentum
-
-        def max_lr():
-            # remain at max for a period
-            return tf.constant(0.85, tf.float32)
-
-        def initial_decay():
-            # decay at half the speed we warmed up at
-            decay_step = step - self._max_end_step
-            momentum = tf.cast(0.85 + 0.1 * (decay_step / (self._decay_end_step - self._max_end_step)), tf.float32)
-            return momentum
-
-        def final_decay():
-            # remain at highest momentum
-            return tf.constant(0.95, tf.float32)
-
-        learning_rate = tf.case([(tf.less_equal(step, self._warmup_end_step), warmup),
-                                 (tf.less_equal(step, self._max_end_step), max_lr),
-                                 (tf.less_equal(step, self._decay_end_step), initial_decay)],
-                                default=final_decay)
-
-        return learning_rate
\ No newline at end of file
+    def momentum(self, step):
+        step = tf.cast(step, tf.float32)
+
+        # interpolate between initial and max momentum
+        warmup = 0.95 - 0.1 * (step / self._warmup_end_step)
+        # decay at half the speed we warmed up at
+        initial_decay = 0.85 + 0.1 * ((step - self._max_end_step) / (self._decay_end_step - self._max_end_step))
+
+        # remain at lowest momentum while lr is max, then remain at highest momentum once decay finishes
+        momentum = tf.where(step <= self._warmup_end_step, warmup,
+                            tf.where(step <= self._max_end_step, 0.85,
+                                     tf.where(step <= self._decay_end_step, initial_decay, 0.95)))
+
+        return momentum
@@ -1,7 +1,10 @@
+import numpy as np
 import tensorflow as tf
+from models.functions.pad_sets import scatter_to_padded
 from models.stochastic_set_prior import StochasticSetPrior
 from models.size_predictor import SizePredictor
 from models.transformer_layers import TransformerLayer, PoolingMultiheadAttention
+from tools import AttrDict
 
 
 class PointwiseProcessing(tf.keras.layers.Layer):
@@ -22,6 +25,7 @@ class SetEncoder(tf.keras.layers.Layer):
     def __init__(self, preprocesing_dim, num_layers, trans_dim, num_heads):
         super(SetEncoder, self).__init__()
 
+        self.trans_dim = trans_dim
         self.pointwise_processing = PointwiseProcessing(preprocesing_dim, trans_dim)
 
         self.num_layers = num_layers
@@ -35,8 +39,9 @@ class SetEncoder(tf.keras.layers.Layer):
             x = self.transformer[i](x, x, mask)
 
         merged = self.transformer_pooling(x, mask)
+        merged = tf.reshape(merged, (-1, self.trans_dim))
 
-        return merged  # (batch_size, input_seq_len, d_model)
+        return merged  # (batch_size, d_model)
 
 
 class SetDecoder(tf.keras.layers.Layer):
@@ -44,13 +49,15 @@ class SetDecoder(tf.keras.layers.Layer):
         super(SetDecoder, self).__init__()
         # process initial set to transformer dimension
         self.embedding = tf.keras.layers.Conv1D(trans_dim, 1, kernel_initializer='glorot_uniform', use_bias=True,
-                                                bias_initializer=tf.constant_initializer(0.1))\
+                                                bias_initializer=tf.constant_initializer(0.1))
+        self.conditioning_embedding = tf.keras.layers.Dense(trans_dim, kernel_initializer='glorot_uniform',
+                                                            use_bias=False)
 
         self.num_layers = num_layers
         self.transformer = [TransformerLayer(trans_dim, num_heads) for _ in range(num_layers)]
 
-    def call(self, initial_set, mask):
-        x = self.embedding(initial_set)
+    def call(self, initial_set, mask, conditioning):
+        x = self.embedding(initial_set) + self.conditioning_embedding(conditioning)
 
         for i in range(self.num_layers):
             x = self.transformer[i](x, x, mask)
@@ -79,49 +86,60 @@ class SetAutoEncoder(tf.keras.Model):
 
         self._size_predictor = SizePredictor(size_pred_width, max_set_size)
 
+        self._weight_cache = AttrDict()
+
+        self._mask_table = tf.constant(np.tril(np.ones((max_set_size + 1, max_set_size), dtype=bool), -1))
+
     def call(self, initial_set, sampled_set, sizes):
-        # get the transformer mask []
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+        masked_values = self._build_mask(sizes)
 
         # encode the input set
         encoded = self._encoder(initial_set, masked_values)  # pooled: [batch_size, num_features]
 
-        # concat the encoded set vector onto each initial set element
-        encoded_shaped = tf.tile(encoded, [1, self.max_set_size, 1])
-        sampled_elements_conditioned = tf.concat([sampled_set, encoded_shaped], 2)
-
-        pred_set_latent = self._decoder(sampled_elements_conditioned, masked_values)
+        encoded_shaped = tf.expand_dims(encoded, 1)
+        pred_set_latent = self._decoder(sampled_set, masked_values, encoded_shaped)
 
         pred_set = self._set_prediction(pred_set_latent)
         return pred_set
 
+    def _build_mask(self, sizes):
+        return tf.gather(self._mask_table, sizes)
+
     def sample_prior(self, sizes):
         total_elements = tf.reduce_sum(sizes)
         sampled_elements = self._prior(total_elements)  # [batch_size, max_set_size, num_features]
         return sampled_elements
 
     def sample_prior_batch(self, sizes):
-        sampled_elements = self.sample_prior(sizes)
-        samples_ragged = tf.RaggedTensor.from_row_lengths(sampled_elements, sizes)
-        padded_samples = samples_ragged.to_tensor(default_value=self.pad_value,
-                                                  shape=[sizes.shape[0], self.max_set_size, self.num_element_features])
-        return padded_samples
+        sampled_elements = tf.convert_to_tensor(self.sample_prior(sizes))     # [total_elements, num_features]
+        return scatter_to_padded(sampled_elements, sizes, self.max_set_size, self.pad_value)
 
     def encode_set(self, initial_set, sizes):
-        return self._encoder(initial_set, sizes)
+        masked_values = self._build_mask(sizes)
+
+        return self._encoder(initial_set, masked_values)
+
+    def predict_size_logits(self, embedding):
+        return self._size_predictor(embedding)
 
     def predict_size(self, embedding):
-        sizes = self._size_predictor(embedding)
+        sizes = self.predict_size_logits(embedding)
         sizes = tf.keras.activations.softmax(sizes, -1)
         return sizes
 
     def get_autoencoder_weights(self):
-        return self._encoder.trainable_weights + \
-               self._decoder.trainable_weights + \
-               self._set_prediction.trainable_weights
+        if 'autoencoder' not in self._weight_cache:
+            self._weight_cache.autoencoder = self._encoder.trainable_weights + \
+                                             self._decoder.trainable_weights + \
+                                             self._set_prediction.trainable_weights
+        return self._weight_cache.autoencoder
 
     def get_prior_weights(self):
-        return self._prior.trainable_weights
+        if 'prior' not in self._weight_cache:
+            self._weight_cache.prior = self._prior.trainable_weights
+        return self._weight_cache.prior
 
     def get_size_predictor_weights(self):
-        return self._size_predictor.trainable_weights
+        if 'size_predictor' not in self._weight_cache:
+            self._weight_cache.size_predictor = self._size_predictor.trainable_weights
+        return self._weight_cache.size_predictor
@@ -1,7 +1,10 @@
+import numpy as np
 import tensorflow as tf
+from models.functions.pad_sets import scatter_to_padded
 from models.stochastic_set_prior import StochasticSetPrior
 from models.size_predictor import SizePredictor
 from models.transformer_layers import TransformerLayer, PoolingMultiheadAttention
+from tools import AttrDict
 import tensorflow_probability as tfp
 
 tfd = tfp.distributions
@@ -62,12 +65,15 @@ class SetDecoder(tf.keras.layers.Layer):
         # process initial set to transformer dimension
         self.embedding = tf.keras.layers.Conv1D(trans_dim, 1, kernel_initializer='glorot_uniform', use_bias=True,
                                                 bias_initializer=tf.constant_initializer(0.1))
+        # the encoded set vector is shared by every element, so project it once and broadcast it across the set
+        self.conditioning_embedding = tf.keras.layers.Dense(trans_dim, kernel_initializer='glorot_uniform',
+                                                            use_bias=False)
 
         self.num_layers = num_layers
         self.transformer = [TransformerLayer(trans_dim, num_heads) for _ in range(num_layers)]
 
-    def call(self, initial_set, mask):
-        x = self.embedding(initial_set)
+    def call(self, initial_set, mask, conditioning):
+        x = self.embedding(initial_set) + self.conditioning_embedding(conditioning)
 
         for i in range(self.num_layers):
             x = self.transformer[i](x, x, mask)
@@ -97,9 +103,14 @@ class SetVariationalAutoEncoder(tf.keras.Model):
 
         self._size_predictor = SizePredictor(size_pred_width, max_set_size)
 
+        self._weight_cache = AttrDict()
+
+        # row n is the transformer mask for a set of size n, with True marking unpadded elements. max_set_size is
+        # fixed, so looking masks up is a single gather rather than rebuilding them from sizes every step
+        self._mask_table = tf.constant(np.tril(np.ones((max_set_size + 1, max_set_size), dtype=bool), -1))
+
     def call(self, initial_set, sampled_set, sizes, eval_mode=False):
-        # get the transformer mask []
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+        masked_values = self._build_mask(sizes)
 
         # encode the input set
         if eval_mode:
@@ -107,17 +118,17 @@ class SetVariationalAutoEncoder(tf.keras.Model):
         else:
             encoded = self._encoder(initial_set, masked_values).sample()  # pooled: [batch_size, num_features]
 
-        # concat the encoded set vector onto each initial set element
+        # condition each initial set element on the encoded set vector, [batch_size, 1, num_features] broadcasts
         encoded_shaped = tf.expand_dims(encoded, 1)
-        encoded_shaped = tf.tile(encoded_shaped, [1, self.max_set_size, 1])
-        sampled_elements_conditioned = tf.concat([sampled_set, encoded_shaped], 2)
-
-        pred_set_latent = self._decoder(sampled_elements_conditioned, masked_values)
+        pred_set_latent = self._decoder(sampled_set, masked_values, encoded_shaped)
 
         mean = self._set_prediction_mean(pred_set_latent)
 
-        dist = tfd.Normal(mean, 0.005)
-        return tfd.Independent(dist, 1)
+        dist = tfd.Normal(mean, 0.005, validate_args=False, allow_nan_stats=False)
+        return tfd.Independent(dist, 1, validate_args=False)
+
+    def _build_mask(self, sizes):
+        return tf.gather(self._mask_table, sizes)
 
     def sample_prior(self, sizes):
         total_elements = tf.reduce_sum(sizes)
@@ -125,44 +136,46 @@ class SetVariationalAutoEncoder(tf.keras.Model):
         return sampled_elements
 
     def sample_prior_batch(self, sizes):
-        sampled_elements = self.sample_prior(sizes)
-        samples_ragged = tf.RaggedTensor.from_row_lengths(sampled_elements, sizes)
-        padded_samples = samples_ragged.to_tensor(default_value=self.pad_value,
-                                                  shape=[sizes.shape[0], self.max_set_size, self.num_element_features])
-        return padded_samples
+        sampled_elements = tf.convert_to_tensor(self.sample_prior(sizes))     # [total_elements, num_features]
+        return scatter_to_padded(sampled_elements, sizes, self.max_set_size, self.pad_value)
 
     def encode_set(self, initial_set, sizes):
-        # get the transformer mask []
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+        masked_values = self._build_mask(sizes)
 
         return self._encoder(initial_set, masked_values)
 
     def decode_set(self, set_latent, initial_set, sizes):
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+        masked_values = self._build_mask(sizes)
 
         encoded_shaped = tf.expand_dims(set_latent, 1)
-        encoded_shaped = tf.tile(encoded_shaped, [1, self.max_set_size, 1])
-        sampled_elements_conditioned = tf.concat([initial_set, encoded_shaped], 2)
-
-        pred_set_latent = self._decoder(sampled_elements_conditioned, masked_values)
+        pred_set_latent = self._decoder(initial_set, masked_values, encoded_shaped)
 
         mean = self._set_prediction_mean(pred_set_latent)
 
-        dist = tfd.Normal(mean, 0.005)
-        return tfd.Independent(dist, 1)
+        dist = tfd.Normal(mean, 0.005, validate_args=False, allow_nan_stats=False)
+        return tfd.Independent(dist, 1, validate_args=False)
+
+    def predict_size_logits(self, embedding):
+        return self._size_predictor(embedding)
 
     def predict_size(self, embedding):
-        sizes = self._size_predictor(embedding)
+        sizes = self.predict_size_logits(embedding)
         sizes = tf.keras.activations.softmax(sizes, -1)
         return sizes
 
     def get_autoencoder_weights(self):
-        return self._encoder.trainable_weights + \
-               self._decoder.trainable_weights + \
-               self._set_prediction_mean.trainable_weights
+        if 'autoencoder' not in self._weight_cache:
+            self._weight_cache.autoencoder = self._encoder.trainable_weights + \
+                                             self._decoder.trainable_weights + \
+                                             self._set_prediction_mean.trainable_weights
+        return self._weight_cache.autoencoder
 
     def get_prior_weights(self):
-        return self._prior.trainable_weights
+        if 'prior' not in self._weight_cache:
+            self._weight_cache.prior = self._prior.trainable_weights
+        return self._weight_cache.prior
 
     def get_size_predictor_weights(self):
-        return self._size_predictor.trainable_weights
+        if 'size_predictor' not in self._weight_cache:
+            self._weight_cache.size_predictor = self._size_predictor.trainable_weights
+        return self._weight_cache.size_predictor
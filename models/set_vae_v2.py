@@ -4,23 +4,22 @@ from models.linear_set_prior import DeterministicSetPrior
 from models.stochastic_set_prior import StochasticSetPrior
 from models.size_predictor import SizePredictor
 from models.transformer_layers import TransformerLayer, PoolingMultiheadAttention, PICASO, GeneralisedPICASO
-import tensorflow_probability as tfp
+from tools import AttrDict
 
-tfd = tfp.distributions
 tfkl = tf.keras.layers
-tfpl = tfp.layers
 
 
 class PointwiseProcessing(tf.keras.layers.Layer):
     def __init__(self, preprocesing_dim, out_dim):
         super(PointwiseProcessing, self).__init__()
-        self.conv1 = tf.keras.layers.Conv1D(preprocesing_dim, 1, kernel_initializer='glorot_uniform', use_bias=True)
-        self.conv2 = tf.keras.layers.Conv1D(out_dim, 1, kernel_initializer='glorot_uniform', use_bias=True)
+        # a kernel size 1 conv is a dense over the feature axis, as a dense mlp the activation fuses into the matmul
+        self.dense1 = tf.keras.layers.Dense(preprocesing_dim, activation=tf.nn.leaky_relu,
+                                            kernel_initializer='glorot_uniform', use_bias=True)
+        self.dense2 = tf.keras.layers.Dense(out_dim, kernel_initializer='glorot_uniform', use_bias=True)
 
     def call(self, set):
-        x = self.conv1(set)
-        x = tf.nn.leaky_relu(x)
-        x = self.conv2(x)
+        x = self.dense1(set)
+        x = self.dense2(x)
 
         return x
 
@@ -37,131 +36,225 @@ class SetEncoder(tf.keras.layers.Layer):
         self.transformer_pooling = PICASO(trans_dim, 1, 1)
 
         latent_dim = 64
-        _latent_prior = tfd.Independent(tfd.Normal(loc=tf.zeros(latent_dim), scale=1), reinterpreted_batch_ndims=1)
+        self.latent_dim = latent_dim
 
-        self.out_parameterization1 = tfkl.Dense(tfpl.IndependentNormal.params_size(latent_dim), activation='relu')
-        self.out_parameterization2 = tfkl.Dense(tfpl.IndependentNormal.params_size(latent_dim), activation=None)
-        self.out_dist = tfpl.IndependentNormal(latent_dim, activity_regularizer=tfpl.KLDivergenceRegularizer(_latent_prior, weight=1.0))
+        # the latent parameters and their KL to the prior stay in float32 when the transformers run in mixed precision.
+        # a shared hidden layer feeds separate mean and log scale heads
+        self.out_hidden = tfkl.Dense(2 * latent_dim, activation=tf.nn.leaky_relu, dtype='float32')
+        self.out_mu = tfkl.Dense(latent_dim, activation=None, dtype='float32')
+        self.out_log_sigma = tfkl.Dense(latent_dim, activation=None, dtype='float32')
 
     def call(self, set, mask):
         x = self.pointwise_processing(set)
 
-        for i in range(self.num_layers):
-            x = self.transformer[i](x, x, mask)
+        for transformer in self.transformer:
+            x = transformer(x, x, mask)
 
         merged = self.transformer_pooling(x, mask)
         merged = tf.reshape(merged, (-1, self.trans_dim))
 
-        dist_params = self.out_parameterization1(merged)
-        dist_params = self.out_parameterization2(dist_params)
-        dist = self.out_dist(dist_params)
+        hidden = self.out_hidden(merged)
+        mu = self.out_mu(hidden)
+        log_sigma = self.out_log_sigma(hidden)
 
-        return dist  # (batch_size, input_seq_len, d_model)
+        # the posterior is a diagonal normal and the prior is N(0, I), so the KL has a closed form. averaged over the
+        # batch, the same as the activity regulariser it replaces
+        kl = 0.5 * tf.reduce_sum(tf.exp(2 * log_sigma) + tf.square(mu) - 1 - 2 * log_sigma, axis=-1)
+        self.add_loss(tf.reduce_mean(kl))
+
+        return mu, log_sigma  # (batch_size, latent_dim)
 
 
 class SetDecoder(tf.keras.layers.Layer):
-    def __init__(self, num_layers, trans_dim, num_heads):
+    def __init__(self, num_layers, trans_dim, num_heads, max_set_size, remove_padding=False):
         super(SetDecoder, self).__init__()
 
         self.num_layers = num_layers
-        self.initial_dense = tf.keras.layers.Conv1D(trans_dim, 1, kernel_initializer='glorot_uniform', use_bias=True)
-
-        self.condition_dense = [tf.keras.layers.Conv1D(trans_dim, 1, kernel_initializer='glorot_uniform', use_bias=True) for _ in range(num_layers)]
+        self.max_set_size = max_set_size
+        self.remove_padding = remove_padding
+        # dense rather than kernel size 1 convs so the pointwise projections also run on packed [num_elements, dim]
+        self.initial_dense = tf.keras.layers.Dense(trans_dim, kernel_initializer='glorot_uniform', use_bias=True)
+
+        # a 1x1 conv over [x, conditioning, pooled] is split into one projection per input, so the per-set
+        # conditioning and pooled vectors can broadcast across the set rather than being tiled to every element
+        self.condition_dense_x = [tf.keras.layers.Dense(trans_dim, kernel_initializer='glorot_uniform', use_bias=True) for _ in range(num_layers)]
+        self.condition_dense_cond = [tf.keras.layers.Dense(trans_dim, kernel_initializer='glorot_uniform', use_bias=False) for _ in range(num_layers)]
+        self.condition_dense_pool = [tf.keras.layers.Dense(trans_dim, kernel_initializer='glorot_uniform', use_bias=False) for _ in range(num_layers)]
         self.transformer = [TransformerLayer(trans_dim, num_heads) for _ in range(num_layers)]
         self.transformer_pooling = PICASO(trans_dim, 1, 1)
 
+    def _layer_stack(self):
+        # the layers making up each decoder block, walked together rather than indexed per block
+        return zip(self.condition_dense_x, self.condition_dense_cond, self.condition_dense_pool, self.transformer)
+
     def call(self, initial_set, mask, conditioning):
-        x = self.initial_dense(initial_set)
+        # masks are built to exactly max_set_size, so pin the set dimension statically for shape specialisation
+        initial_set.set_shape([None, self.max_set_size, None])
+
+        if not self.remove_padding:
+            return self._call_padded(initial_set, mask, conditioning)
+
+        # packing only pays for itself when there is a decent amount of padding to skip
+        fill = tf.reduce_mean(tf.cast(mask, tf.float32))
+        return tf.cond(fill > 0.9,
+                       lambda: self._call_padded(initial_set, mask, conditioning),
+                       lambda: self._call_packed(initial_set, mask, conditioning))
+
+    def _call_padded(self, initial_set, mask, conditioning):
+        return self._decode_blocks(initial_set, mask, conditioning, lambda layer, x: layer(x))
+
+    def _call_packed(self, initial_set, mask, conditioning):
+        # the pointwise projections only run on the real elements, attention and pooling mix positions within a set
+        # so they stay padded. the packed shapes are data dependent, so this path can't be XLA compiled
+        indices = tf.where(mask)   # [num_elements, 2] of (batch, position)
+        padded_shape = tf.shape(initial_set, out_type=tf.int64)[:2]
+
+        def packed(layer, x):
+            out = layer(tf.gather_nd(x, indices))
+            padded = tf.scatter_nd(indices, out, tf.concat([padded_shape, tf.shape(out, out_type=tf.int64)[1:]], 0))
+            # the scatter shape is computed, so restore the static shape the following layers build from
+            padded.set_shape([None, self.max_set_size, out.shape[-1]])
+            return padded
+
+        return self._decode_blocks(initial_set, mask, conditioning, packed)
+
+    def _decode_blocks(self, initial_set, mask, conditioning, pointwise):
+        # pointwise(layer, x) applies a per element projection, either to the whole padded set or only to its real
+        # elements, and returns it padded. everything else is shared by both paths
+        x = pointwise(self.initial_dense, initial_set)
 
-        for i in range(self.num_layers):
-            current_pooled = self.transformer_pooling(x, mask)
-            current_pooled = tf.tile(current_pooled, [1, tf.shape(x)[1], 1])
+        for dense_x, dense_cond, dense_pool, transformer in self._layer_stack():
+            current_pooled = self.transformer_pooling(x, mask)     # [batch_size, 1, trans_dim]
 
-            x = tf.concat([x, conditioning, current_pooled], 2)     # add conditioning vector to each point
-            x = self.condition_dense[i](x)                   # process set to transformer dimension
+            # add conditioning vector to each point and process set to transformer dimension
+            x = pointwise(dense_x, x) + dense_cond(conditioning) + dense_pool(current_pooled)
 
-            x = self.transformer[i](x, x, mask)
+            x = transformer(x, x, mask)
 
         return x
 
 
 class SetVariationalAutoEncoderV2(tf.keras.Model):
     def __init__(self, encoder_latent, transformer_layers, transformer_dim,
-                 transformer_num_heads, num_element_features, size_pred_width, pad_value, max_set_size):
+                 transformer_num_heads, num_element_features, size_pred_width, pad_value, max_set_size,
+                 remove_padding=False):
         super(SetVariationalAutoEncoderV2, self).__init__()
 
         self.pad_value = pad_value
         self.max_set_size = max_set_size
         self.num_element_features = num_element_features
 
-        self._prior = DeterministicSetPrior(num_element_features, self.max_set_size)
+        # the initial set and the size softmax are cheap and feed float32 losses, so they stay out of mixed precision
+        self._prior = DeterministicSetPrior(num_element_features, self.max_set_size, dtype='float32')
 
         self._encoder = SetEncoder(encoder_latent, transformer_layers, transformer_dim, transformer_num_heads)
 
-        self._decoder = SetDecoder(transformer_layers, transformer_dim, transformer_num_heads)
+        self._decoder = SetDecoder(transformer_layers, transformer_dim, transformer_num_heads, max_set_size,
+                                   remove_padding)
 
-        # initialise the output to predict points at the center of our canvas
-        self._set_prediction_mean = tf.keras.layers.Conv1D(num_element_features, 1, use_bias=True,
-                                                           kernel_initializer='zeros',
-                                                           bias_initializer=tf.keras.initializers.constant(0.5))
+        # initialise the output to predict points at the center of our canvas, kept in float32 for the loss. a dense
+        # on [batch_size, max_set_size, trans_dim] is a single [batch_size * max_set_size, trans_dim] matmul with the
+        # bias add fused in, rather than going through the conv path for a kernel size 1 conv
+        self._set_prediction_mean = tf.keras.layers.Dense(num_element_features, use_bias=True,
+                                                          kernel_initializer='zeros',
+                                                          bias_initializer=tf.keras.initializers.constant(0.5),
+                                                          dtype='float32')
 
-        self._size_predictor = SizePredictor(size_pred_width, max_set_size)
+        self._size_predictor = SizePredictor(size_pred_width, max_set_size, dtype='float32')
+
+        # the trainable weights don't change once the model is built, so only walk the layers for them once. this is
+        # a plain AttrDict rather than attributes so keras doesn't track the cached lists as extra dependencies
+        self._weight_cache = AttrDict()
+
+        # max_set_size is a python int so every padded shape is static, which lets XLA fuse the elementwise work
+        # around each transformer layer. the packed decoder has data dependent shapes, so it runs without XLA
+        self._call = tf.function(self._forward, jit_compile=not remove_padding)
+        self._decode_set = tf.function(self._decode, jit_compile=not remove_padding)
+        # the encoder is always padded. with the mask built inside the compiled region, XLA can fuse the sequence mask
+        # into the pointwise preprocessing and the first attention layer's mask select
+        self._encode_set = tf.function(self._encode, jit_compile=True)
 
-    @tf.function
     def call(self, initial_set, sampled_set, sizes, eval_mode=False):
-        # get the transformer mask []
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+        return self._call(initial_set, sampled_set, sizes, eval_mode)
+
+    def _forward(self, initial_set, sampled_set, sizes, eval_mode=False):
+        # built once and shared by the encoder and decoder
+        masked_values = self._build_mask(sizes)
 
         # encode the input set
-        if eval_mode:
-            encoded = self._encoder(initial_set, masked_values).mode()
-        else:
-            encoded = self._encoder(initial_set, masked_values).sample()  # pooled: [batch_size, num_features]
+        mu, log_sigma = self._encoder(initial_set, masked_values)
+        encoded = self._sample_latent(mu, log_sigma, eval_mode)  # pooled: [batch_size, num_features]
+
+        return self._decode_latent(encoded, sampled_set, masked_values)
 
-        # concat the encoded set vector onto each initial set element
-        encoded_shaped = tf.expand_dims(encoded, 1)
-        conditioning = tf.tile(encoded_shaped, [1, self.max_set_size, 1])
+    def _decode_latent(self, set_latent, initial_set, masked_values):
+        # condition each initial set element on the encoded set vector. it is kept as [batch_size, 1, num_features]
+        # and broadcast by the decoder's conditioning projection, never tiled out to every element
+        encoded_shaped = tf.expand_dims(set_latent, 1)
 
-        pred_set_latent = self._decoder(sampled_set, masked_values, conditioning)
+        pred_set_latent = self._decoder(initial_set, masked_values, encoded_shaped)
 
         pred = self._set_prediction_mean(pred_set_latent)
         return pred
 
+    def _build_mask(self, sizes):
+        # get the boolean transformer mask [batch_size, max_set_size]. attention broadcasts it over heads and queries
+        # inside its select, so no float mask is materialised whatever the compute dtype
+        return tf.sequence_mask(sizes, self.max_set_size)
+
     def sample_prior_batch(self, sizes):
         return self._prior(sizes)
 
-    def encode_set(self, initial_set, sizes):
-        # get the transformer mask []
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+    def _sample_latent(self, mu, log_sigma, eval_mode):
+        # the mode in eval, otherwise a reparameterised sample. written out directly so XLA fuses the noise, exp,
+        # multiply and add into one kernel
+        if eval_mode:
+            return mu
+        eps = tf.random.normal(tf.shape(mu), dtype=mu.dtype)
+        return mu + tf.exp(log_sigma) * eps
+
+    def encode_set(self, initial_set, sizes, eval_mode=False):
+        return self._encode_set(initial_set, tf.cast(sizes, tf.int32), eval_mode)
 
-        return self._encoder(initial_set, masked_values)
+    def _encode(self, initial_set, sizes, eval_mode=False):
+        masked_values = self._build_mask(sizes)
+
+        mu, log_sigma = self._encoder(initial_set, masked_values)
+        return self._sample_latent(mu, log_sigma, eval_mode)
 
     def decode_set(self, set_latent, initial_set, sizes):
-        masked_values = tf.reshape(tf.cast(tf.math.logical_not(tf.sequence_mask(sizes, self.max_set_size)), tf.float32), [-1, 1, 1, self.max_set_size])
+        return self._decode_set(set_latent, initial_set, sizes)
 
-        encoded_shaped = tf.expand_dims(set_latent, 1)
-        encoded_shaped = tf.tile(encoded_shaped, [1, self.max_set_size, 1])
-        sampled_elements_conditioned = tf.concat([initial_set, encoded_shaped], 2)
+    def _decode(self, set_latent, initial_set, sizes):
+        masked_values = self._build_mask(sizes)
 
-        pred_set_latent = self._decoder(sampled_elements_conditioned, masked_values)
+        return self._decode_latent(set_latent, initial_set, masked_values)
 
-        mean = self._set_prediction_mean(pred_set_latent)
+    @property
+    def latent_dim(self):
+        return self._encoder.latent_dim
 
-        dist = tfd.Normal(mean, 0.005)
-        return tfd.Independent(dist, 1)
+    def predict_size_logits(self, embedding):
+        return self._size_predictor(embedding)
 
     def predict_size(self, embedding):
-        sizes = self._size_predictor(embedding)
+        sizes = self.predict_size_logits(embedding)
         sizes = tf.keras.activations.softmax(sizes, -1)
         return sizes
 
     def get_autoencoder_weights(self):
-        return self._encoder.trainable_weights + \
-               self._decoder.trainable_weights + \
-               self._set_prediction_mean.trainable_weights
+        if 'autoencoder' not in self._weight_cache:
+            self._weight_cache.autoencoder = self._encoder.trainable_weights + \
+                                             self._decoder.trainable_weights + \
+                                             self._set_prediction_mean.trainable_weights
+        return self._weight_cache.autoencoder
 
     def get_prior_weights(self):
-        return self._prior.trainable_weights
+        if 'prior' not in self._weight_cache:
+            self._weight_cache.prior = self._prior.trainable_weights
+        return self._weight_cache.prior
 
     def get_size_predictor_weights(self):
-        return self._size_predictor.trainable_weights
+        if 'size_predictor' not in self._weight_cache:
+            self._weight_cache.size_predictor = self._size_predictor.trainable_weights
+        return self._weight_cache.size_predictor
@@ -2,10 +2,11 @@ import tensorflow as tf
 
 
 class SizePredictor(tf.keras.Model):
-    def __init__(self, hidden_size, max_units):
-        super(SizePredictor, self).__init__()
-        self.h1 = tf.keras.layers.Dense(hidden_size, kernel_initializer='glorot_uniform')
-        self.h2 = tf.keras.layers.Dense(max_units, kernel_initializer='glorot_uniform')
+    def __init__(self, hidden_size, max_units, dtype=None):
+        super(SizePredictor, self).__init__(dtype=dtype)
+        # sub-layers follow the global policy unless given a dtype, so pass it through to keep the whole head in it
+        self.h1 = tf.keras.layers.Dense(hidden_size, kernel_initializer='glorot_uniform', dtype=dtype)
+        self.h2 = tf.keras.layers.Dense(max_units, kernel_initializer='glorot_uniform', dtype=dtype)
 
     def call(self, inputs, training=None, mask=None):
         out1 = self.h1(inputs)
@@ -53,26 +53,31 @@ def scaled_dot_product_attention(q, k, v, mask):
     """Calculate the attention weights.
     q, k, v must have matching leading dimensions.
     k, v must have matching penultimate dimension, i.e.: seq_len_k = seq_len_v.
-    The mask has different shapes depending on its type(padding or look ahead)
-    but it must be broadcastable for addition.
+    The mask is a boolean padding mask over the keys, broadcast across the heads
+    and queries.
     Args:
       q: query shape == (..., seq_len_q, depth)
       k: key shape == (..., seq_len_k, depth)
       v: value shape == (..., seq_len_v, depth_v)
-      mask: Float tensor with shape broadcastable
-            to (..., seq_len_q, seq_len_k). Defaults to None.
+      mask: Bool keep mask with shape (batch_size, seq_len_k), True where k may
+            be attended to. Defaults to None.
     Returns:
       output, attention_weights
     """
 
     matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
 
-    # scale matmul_qk to stabilise gradients
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+    # scale matmul_qk to stabilise gradients, the head depth is static so this stays a compile time constant
+    dk = k.shape[-1]
+    if dk is None:
+        dk = tf.shape(k)[-1]
+    scaled_attention_logits = matmul_qk / tf.math.sqrt(tf.cast(dk, matmul_qk.dtype))
 
+    # select rather than add a large negative, so there's no extra multiply and padding can't overflow in fp16. the
+    # mask is expanded in place to (batch_size, 1, 1, seq_len_k) so XLA folds the broadcast into the select
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        scaled_attention_logits = tf.where(mask[:, None, None, :], scaled_attention_logits,
+                                           scaled_attention_logits.dtype.min)
 
     # softmax is normalized on the last axis (seq_len_k) so that the scores add up to 1.
     attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
@@ -166,7 +171,8 @@ class GeneralisedPICASO(tf.keras.layers.Layer):
         s = self.seed_vectors
         s = tf.tile(s, [b, 1, 1])  # shape [b, k, d]
 
-        X_mask = tf.zeros((b, 1, 1, 1), x.dtype)
+        # attend to every seed vector, the size 1 key axis broadcasts across them
+        X_mask = tf.ones((b, 1), tf.bool)
 
         H = self.mab(s, x, mask)
         X_prime = self.mab0(x, H, X_mask)
@@ -14,8 +14,6 @@ from visualisation import mnist_example
 import math
 import argparse
 import os
-import decimal
-from re import sub
 import tensorflow_addons as tfa
 
 
@@ -77,18 +75,15 @@ class RandomPointVAE:
             self.vae.built = True
 
             def extract_sortable_value(value):
-                first_value = sub(r"\D", "", value)
-                return decimal.Decimal(first_value)
+                return int("".join(c for c in os.path.basename(value) if c.isdigit()) or 0)
 
             run_folders = [f.path for f in os.scandir(checkpoint_folder) if f.is_dir()]
-            run_folders = sorted(run_folders, key=extract_sortable_value)
-            latest_run = run_folders[-1]
+            latest_run = max(run_folders, key=extract_sortable_value)
 
             step_ckpnts = [f.path for f in os.scandir(latest_run) if f.is_dir()]
 
             if load_step == -1:
-                step_ckpnts = sorted(step_ckpnts, key=extract_sortable_value)
-                step_folder = step_ckpnts[-1]
+                step_folder = max(step_ckpnts, key=extract_sortable_value)
             else:
                 step_folder = [x for x in step_ckpnts if str(load_step) in x][0]
 
@@ -156,12 +151,11 @@ class RandomPointVAE:
             val_count = 0
 
             for val_step, (images, sets, sizes, labels) in enumerate(val_ds):
-                predicted_sizes, val_model_loss = self.eval_size_predictor_step(sets, sizes)
-                for i in range(len(predicted_sizes)):
-                    val_count += 1
-                    val_model_SE_sum += math.pow(predicted_sizes[i] - sizes[i], 2)
+                squared_error, batch_count, val_model_loss = self.eval_size_predictor_step(sets, sizes)
+                val_model_SE_sum += squared_error
+                val_count += batch_count
 
-            rmse = math.sqrt(val_model_SE_sum / val_count)
+            rmse = math.sqrt(float(val_model_SE_sum) / int(val_count))
 
             with self.summary_writer.as_default():
                 tf.summary.scalar('val/size predictor RMSE', rmse, step=step)
@@ -220,11 +214,12 @@ class RandomPointVAE:
 
     @tf.function
     def size_predictor_loss(self, embedded_sets, sizes):
-        pred_sizes = self.vae.predict_size(embedded_sets)
+        pred_size_logits = self.vae.predict_size_logits(embedded_sets)
 
-        one_hot_sizes = tf.one_hot(sizes - 1, self.max_set_size)    # decrement indices by 1 as not sets are size 0
-        size_loss = tf.reduce_mean(tf.keras.losses.categorical_crossentropy(one_hot_sizes, pred_sizes))
-        predicted_sizes = tf.cast(tf.argmax(pred_sizes, 1), tf.int32) + 1
+        # decrement indices by 1 as not sets are size 0
+        size_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=sizes - 1,
+                                                                                  logits=pred_size_logits))
+        predicted_sizes = tf.argmax(pred_size_logits, 1, output_type=tf.int32) + 1
         return predicted_sizes, size_loss
 
     @tf.function
@@ -244,7 +239,8 @@ class RandomPointVAE:
         embedded_sets = self.vae.encode_set(initial_sets, sizes)  # pooled: [batch_size, num_features]
         set_sizes_pred, size_loss = self.size_predictor_loss(embedded_sets, sizes)
 
-        return set_sizes_pred, size_loss
+        squared_error = tf.reduce_sum(tf.square(tf.cast(set_sizes_pred - sizes, tf.float32)))
+        return squared_error, tf.shape(sizes)[0], size_loss
 
 
 if __name__ == '__main__':